@@ -29,6 +29,7 @@ extras = {
         "cchardet >= 2.1.7; python_version < '3.11'",  # build issue
         "faust-cchardet >= 2.1.19; python_version >= '3.11'",
         "htmldate[speed] >= 1.8.1",
+        "isal >= 1.0.0; python_version >= '3.7'",
         "py3langid >= 0.2.2",
         "pycurl >= 7.45.3",
         "zstandard >= 0.20.0",
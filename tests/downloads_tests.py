@@ -47,7 +47,8 @@ from trafilatura.downloads import (DEFAULT_HEADERS, USER_AGENT, Response,
                                    add_to_compressed_dict, fetch_url,
                                    is_live_page, load_download_buffer)
 from trafilatura.settings import DEFAULT_CONFIG, args_to_extractor, use_config
-from trafilatura.utils import decode_file, decode_response, handle_compressed_file, load_html
+from trafilatura.utils import (decode_file, decode_files, decode_response,
+                               handle_compressed_file, load_html)
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
@@ -199,8 +200,13 @@ def test_decode():
         assert handle_compressed_file(zstd_string) == html_string.encode("utf-8")
         assert decode_file(zstd_string) == html_string
     # errors
-    for bad_file in ("äöüß", b"\x1f\x8b\x08abc", b"\x28\xb5\x2f\xfdabc"):
+    for bad_file in ("äöüß", b"\x1f\x8b\x08abc", b"\x28\xb5\x2f\xfdabc", b"\x78\x9cabc", b"\x78\x00abc"):
         assert handle_compressed_file(bad_file) == bad_file
+    # parallel decoding
+    assert list(decode_files([gz_string, deflate_string, b" "])) == [html_string, html_string, " "]
+    results = decode_files([gz_string]*100)
+    assert next(results) == html_string
+    results.close()
 
 
 def test_queue():
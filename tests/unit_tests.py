@@ -4,6 +4,7 @@ Unit tests for the trafilatura library.
 """
 
 import logging
+import re
 import sys
 import time
 
@@ -13,6 +14,7 @@ from os import path
 import pytest
 
 from lxml import etree, html
+from lxml.etree import XPath
 
 
 try:
@@ -31,9 +33,12 @@ from trafilatura.meta import reset_caches
 from trafilatura.metadata import Document
 from trafilatura.readability_lxml import is_probably_readerable
 from trafilatura.settings import DEFAULT_CONFIG, TAG_CATALOG, use_config
-from trafilatura.utils import (LANGID_FLAG, detect_encoding, is_dubious_html, is_image_file,
+from trafilatura.utils import (LANGID_FLAG, PRINTABLES_TABLE, detect_encoding,
+                               fromstring_bytes, is_dubious_html, is_image_file, is_utf8,
                                language_classifier, load_html, normalize_unicode,
-                               repair_faulty_html, sanitize, textfilter, trim)
+                               remove_control_characters, repair_faulty_html, sanitize,
+                               textfilter, trim)
+from trafilatura.xpaths import HIDDEN_XPATH
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
@@ -95,6 +100,10 @@ def test_trim():
     # my_elem.text = 'Tags: Arbeit, Urlaub'
     my_elem.text = 'Instagram'
     assert textfilter(my_elem) is True
+    my_elem.text = '* - ' * 50 + 'Twitter'
+    assert textfilter(my_elem) is True
+    my_elem.text = '* - ' * 50 + 'Text'
+    assert textfilter(my_elem) is False
     my_elem.text = '\t\t'
     assert textfilter(my_elem) is True
     # sanitize logic
@@ -102,11 +111,21 @@ def test_trim():
     # non-breaking spaces
     print(sanitize('Test&nbsp;Text'))
     assert sanitize('Test&nbsp;Text') == 'Test Text'
+    # control characters
+    assert sanitize('Test\x00Text\x1f') == 'TestText'
+    # attributes with a colon
+    mytree = html.fromstring('<html><body><p fb:a="1" og:b="" data-c="">Text</p></body></html>')
+    assert trafilatura.utils.sanitize_tree(mytree).find('.//p').keys() == ['data-c']
     # clear cache
-    # reset caches: examine_date_elements used above
-    old_values = trim.cache_info()
+    # reset caches: control characters looked up above
+    assert PRINTABLES_TABLE
+    reset_caches()
+    assert not PRINTABLES_TABLE
+    # the table does not grow past its limit
+    teststring = "".join(map(chr, range(0x4E00, 0x4E00 + PRINTABLES_TABLE.maxsize + 100))) + "\x07"
+    assert remove_control_characters(teststring) == teststring[:-1]
+    assert len(PRINTABLES_TABLE) == PRINTABLES_TABLE.maxsize
     reset_caches()
-    assert trim.cache_info() != old_values
 
 
 def test_input():
@@ -116,6 +135,21 @@ def test_input():
     teststring = "高山云雾出好茶".encode("gb18030")
     assert "gb18030" in detect_encoding(teststring)
     assert "gb18030" in detect_encoding(teststring*1000)
+    # sample boundaries inside a multibyte character, with or without markup nearby
+    assert "gb18030" in detect_encoding(b"<html><body><p>x" + teststring*1000 + b"</p></body></html>")
+    assert "gb18030" in detect_encoding(b"<html><body><p>x" + (teststring + b"</p>\n<p>")*1000 + b"</p></body></html>")
+    # invalid byte beyond the first kilobyte
+    teststring = b"a"*2000 + "é".encode("latin-1")
+    assert detect_encoding(teststring) != ["utf-8"]
+    # large input with characters cut at the sample boundaries
+    assert is_utf8(b"a" + "é€𝄞".encode("utf-8")*200000) is True
+    assert is_utf8("é€𝄞".encode("utf-8")*200000 + b"\xe9") is False
+    # UTF-16/32 documents above the sampling threshold, with or without BOM
+    htmlstring = "<html><body>" + "<p>Ça été écrit à Zürich.</p>\n"*500 + "</body></html>"
+    for encoding in ("utf-16", "utf-16-le", "utf-16-be", "utf-32"):
+        teststring = htmlstring.encode(encoding)
+        assert len(teststring) > 10000
+        assert teststring.decode(detect_encoding(teststring)[0]) == htmlstring
 
     assert is_dubious_html("This is a string.") is True
 
@@ -144,6 +178,10 @@ def test_input():
     assert load_html('<html><body>ÄÖÜ</body></html>') is not None
     assert load_html(b'<html><body>\x2f\x2e\x9f</body></html>') is not None
     assert load_html('<html><body>\x2f\x2e\x9f</body></html>'.encode('latin-1')) is not None
+    assert fromstring_bytes('<html><body>ÄÖÜ</body></html>'.encode('utf-8')).text_content() == 'ÄÖÜ'
+    # encoding declaration
+    htmlstring = '<?xml version="1.0" encoding="utf-8"?>\n<html><body><p>ÄÖÜ</p></body></html>'
+    assert load_html(htmlstring).text_content() == 'ÄÖÜ'
     #assert load_html(b'0'*int(10e3)) is None
     # old: with pytest.raises(TypeError) as err:
     assert extract(None, 'url', '0000', target_language=None) is None
@@ -448,6 +486,9 @@ def test_images():
     # file type
     assert is_image_file('test.jpg') is True
     assert is_image_file('test.txt') is False
+    assert is_image_file('test.jpg?size=large') is True
+    assert is_image_file('test .png') is False
+    assert is_image_file('data:image/svg+xml;base64,' + 'A'*100000) is False
     # tag with attributes
     assert handle_image(html.fromstring('<img src="test.jpg"/>')) is not None
     assert handle_image(html.fromstring('<img data-src="test.jpg" alt="text" title="a title"/>')) is not None
@@ -715,6 +756,41 @@ def test_htmlprocessing():
     options.images, options.tables = True, False
     myconverted = trafilatura.htmlprocessing.tree_cleaning(mydoc, options)
     assert myconverted.xpath('.//graphic') and not myconverted.xpath('.//table')
+    # preserve patterns
+    mydoc = html.fromstring('<html><body><article><p>Main</p></article><footer><p>Call 0123456789</p><p>Junk</p></footer><aside><p>Other</p></aside></body></html>')
+    preserve_options = Extractor(preserve=[r'\d{10}', 'Unknown'])
+    assert len(preserve_options.preserve) == 1
+    assert preserve_options.preserve[0].search('0123456789') and preserve_options.preserve[0].search('Unknown')
+    mycleaned = trafilatura.htmlprocessing.tree_cleaning(mydoc, preserve_options)
+    assert mycleaned.xpath('.//div/p[@preserve-content]') and not mycleaned.xpath('.//aside|.//footer')
+    assert 'Junk' not in mycleaned.text_content() and 'Other' not in mycleaned.text_content()
+    assert not Extractor().preserve
+    # inline flags, groups and precompiled patterns are kept separate
+    preserve_options = Extractor(preserve=['(?i)contact', re.compile('foo', re.I), r'(a)\1', r'(b)\1'])
+    assert len(preserve_options.preserve) == 4
+    for text in ('CONTACT', 'FOO', 'aa', 'bb'):
+        assert any(pattern.search(text) for pattern in preserve_options.preserve)
+    mydoc = html.fromstring('<html><body><article><p>Main</p></article><footer><p>Contact</p><p>Junk</p></footer></body></html>')
+    mycleaned = trafilatura.htmlprocessing.tree_cleaning(mydoc, preserve_options)
+    assert 'Contact' in mycleaned.text_content() and 'Junk' not in mycleaned.text_content()
+    # recall: do not delete elements if no paragraph is left
+    mydoc = html.fromstring('<html><body><aside><p>Text</p></aside><nav>Nav</nav></body></html>')
+    mycleaned = trafilatura.htmlprocessing.tree_cleaning(mydoc, Extractor(recall=True))
+    assert mycleaned.xpath('.//aside/p') and mycleaned.xpath('.//nav')
+    mydoc = html.fromstring('<html><body><aside><p>Text</p></aside><p>Other</p></body></html>')
+    mycleaned = trafilatura.htmlprocessing.tree_cleaning(mydoc, Extractor(recall=True))
+    assert not mycleaned.xpath('.//aside') and mycleaned.xpath('.//p')
+    # pruning with backup: keep the tree if most of the text would be lost
+    mydoc = html.fromstring('<html><body><div class="ad hidden">' + 'Hidden text. '*20 + '</div><p>Text</p></body></html>')
+    mypruned = trafilatura.htmlprocessing.prune_unwanted_nodes(mydoc, HIDDEN_XPATH, with_backup=True)
+    assert mypruned.xpath('.//div[@class="ad hidden"]')
+    mydoc = html.fromstring('<html><body><div class="ad hidden">Hidden</div><p>' + 'Text. '*20 + '</p></body></html>')
+    mypruned = trafilatura.htmlprocessing.prune_unwanted_nodes(mydoc, HIDDEN_XPATH, with_backup=True)
+    assert not mypruned.xpath('.//div[@class="ad hidden"]') and mypruned.xpath('.//p')
+    # nodes selected by several expressions
+    mydoc = html.fromstring('<html><body><div class="x">Hidden</div>Tail<p>' + 'Text. '*20 + '</p></body></html>')
+    mypruned = trafilatura.htmlprocessing.prune_unwanted_nodes(mydoc, [XPath('.//div'), XPath('.//*[@class="x"]')], with_backup=True)
+    assert not mypruned.xpath('.//div') and mypruned.text_content().count('Tail') == 1
     mydoc = html.fromstring('<html><body><article><h1>Test headline</h1><p>Test</p></article></body></html>')
     assert '<head rend="h1">Test headline</head>' in extract(copy(mydoc), output_format='xml', config=ZERO_CONFIG, no_fallback=True)
     assert '<ab rend="h1" type="header">Test headline</ab>' in extract(copy(mydoc), output_format='xmltei', config=ZERO_CONFIG, no_fallback=True)
@@ -1275,6 +1351,7 @@ def test_lang_detection():
         result = extract(sample['html'], no_fallback=False, config=ZERO_CONFIG)
         detected = language_classifier(result, "")
         assert detected == sample['expected'] or not LANGID_FLAG
+    assert language_classifier("", " \n") is None
 
 
 def test_config_loading():
@@ -5,11 +5,10 @@ Functions to process nodes in HTML code.
 
 import logging
 
-from copy import deepcopy
-import re
+from urllib.parse import urlsplit
 
 from courlan.urlutils import fix_relative_urls, get_base_url
-from lxml.etree import Element, strip_tags, tostring
+from lxml.etree import Element, XPath, strip_tags, tostring
 
 from .deduplication import duplicate_test
 from .settings import CUT_EMPTY_ELEMS, MANUALLY_CLEANED, MANUALLY_STRIPPED
@@ -33,6 +32,8 @@ REND_TAG_MAPPING = {
     'sup': '#sup'
 }
 
+REND_TAGS = tuple(REND_TAG_MAPPING)
+
 HTML_TAG_MAPPING = {v: k for k, v in REND_TAG_MAPPING.items()}
 
 
@@ -40,6 +41,14 @@ PRESERVE_IMG_CLEANING = {'figure', 'picture', 'source'}
 
 MANUALLY_CLEANED_CHECK_CONTENT = ['aside', 'footer']
 
+# compiled once, evaluated on every document
+FIGURE_TABLE_XPATH = XPath('.//figure[descendant::table]')
+LINKS_XPATH = XPath('.//div//a|.//ul//a')  # .//p//a ?
+LINKS_TABLES_XPATH = XPath('.//div//a|.//ul//a|.//table//a')
+REF_HEAD_XPATH = XPath('//ref[head]')
+REF_DESCENDANTS_XPATH = XPath('.//ref')
+CODE_SPAN_XPATH = XPath(".//span[starts-with(@class,'hljs')]")
+
 
 def delete_element(element):
     "Remove the element from the LXML tree."
@@ -49,16 +58,17 @@ def delete_element(element):
         element.getparent().remove(element)
 
 def check_preserve(element, patterns):
-    """Check if the element or its descendants should be preserved based on patterns."""
-    for text in element.itertext():
-        if any(re.search(pattern, text) for pattern in patterns):
-            return True
-    return False
-
-def mark_preserve(element):
-    """Mark the element and its ancestors for preservation."""
-    while element is not None and 'preserve-content' not in element.attrib:
+    """Check if the text directly attached to the element matches one of the
+       precompiled patterns, descendants being covered by their own text and tail."""
+    return bool(element.text) and isinstance(element.tag, str) and \
+           any(pattern.search(element.text) for pattern in patterns)
+
+def mark_preserve(element, marked):
+    """Mark the element and its ancestors for preservation, stopping at the
+       first one found in the set of already marked elements."""
+    while element is not None and element not in marked:
         element.set('preserve-content', 'true')
+        marked.add(element)
         element = element.getparent()
 
 
@@ -71,7 +81,7 @@ def tree_cleaning(tree, options):
         cleaning_list.extend(['table', 'td', 'th', 'tr'])
     else:
         # prevent this issue: https://github.com/adbar/trafilatura/issues/301
-        for elem in tree.xpath('.//figure[descendant::table]'):
+        for elem in FIGURE_TABLE_XPATH(tree):
             elem.tag = 'div'
     if options.images:
         # Many websites have <img> inside <figure> or <picture> or <source> tag
@@ -86,37 +96,50 @@ def tree_cleaning(tree, options):
     # strip targeted elements
     strip_tags(tree, stripping_list)
 
-    # prevent removal of paragraphs
+    # single traversal, materialized since deletions mutate the tree
+    cleaning_targets = list(tree.iter(*cleaning_list))
+
+    # prevent removal of paragraphs: skip deletions if no <p> would survive
     if options.focus == "recall" and tree.find('.//p') is not None:
-        tcopy = deepcopy(tree)
-        for expression in cleaning_list:
-            for element in tree.getiterator(expression):
-                delete_element(element)
-        if tree.find('.//p') is None:
-            tree = tcopy
+        targets = set(cleaning_targets)
+        if all(p in targets or any(a in targets for a in p.iterancestors())
+               for p in tree.iter('p')):
+            cleaning_targets = []
+
     # delete targeted elements
-    else:
-        for expression in cleaning_list:
-            for element in tree.getiterator(expression):
-                delete_element(element)
+    for element in cleaning_targets:
+        delete_element(element)
     
     if options.preserve:
-        # Collect and mark elements to preserve
+        # patterns are compiled once per Extractor object
+        patterns = options.preserve
+        # keep references: lxml proxies are stable as long as they are alive
+        marked = set()
+        candidates = []
+        # Collect and mark elements to preserve, scanning each text segment once,
+        # and gather the elements to check in the same walk
         for element in tree.iter():
-            if check_preserve(element, options.preserve):
-                mark_preserve(element)
-        
+            if element.tag in MANUALLY_CLEANED_CHECK_CONTENT:
+                candidates.append(element)
+            if check_preserve(element, patterns):
+                mark_preserve(element, marked)
+            # the tail is part of the parent's content
+            if element.tail and any(pattern.search(element.tail) for pattern in patterns):
+                mark_preserve(element.getparent(), marked)
+
         # Remove non-preserved children of elements in MANUALLY_CLEANED_CHECK_CONTENT
-        for expression in MANUALLY_CLEANED_CHECK_CONTENT:
-            for element in tree.iter(expression):
-                if 'preserve-content' not in element.attrib:
-                    delete_element(element)
-                else:
-                    element.tag = 'div'
-                    children = list(element)
-                    for child in children:
-                        if 'preserve-content' not in child.attrib:
-                            delete_element(child)
+        for element in candidates:
+            # already removed as a child of a preserved element
+            if element.getparent() is None:
+                continue
+            if element.get('preserve-content') is None:
+                delete_element(element)
+            else:
+                element.tag = 'div'
+                children = list(element)
+                for child in children:
+                    if child.get('preserve-content') is None:
+                        delete_element(child)
 
     return prune_html(tree)
 
@@ -124,36 +147,43 @@ def tree_cleaning(tree, options):
 def prune_html(tree):
     "Delete selected empty elements to save space and processing time."
     # //comment() needed for date extraction
-    for element in tree.xpath("//processing-instruction()|//*[not(node())]"):
-        if element.tag in CUT_EMPTY_ELEMS:
-            delete_element(element)
+    # collect first: deletions should not cascade to emptied parents
+    empty_elems = [e for e in tree.iter(*CUT_EMPTY_ELEMS) if len(e) == 0 and not e.text]
+    for element in empty_elems:
+        delete_element(element)
     return tree
 
 
 def prune_unwanted_nodes(tree, nodelist, with_backup=False):
     '''Prune the HTML tree by removing unwanted sections.'''
     if with_backup:
+        # select everything first and only prune if enough text is left,
+        # so that neither a backup copy nor a second text count is needed
         old_len = len(tree.text_content())  # ' '.join(tree.itertext())
-        backup = deepcopy(tree)
-
-    for expression in nodelist:
-        for subtree in expression(tree):
-            # preserve tail text from deletion
-            if subtree.tail is not None:
-                prev = subtree.getprevious()
-                if prev is None:
-                    prev = subtree.getparent()
-                if prev is not None:
-                    # There is a previous node, append text to its tail
-                    prev.tail = (prev.tail or "") + " " + subtree.tail
-            # remove the node
-            if "preserve-content" not in subtree.attrib:
-                subtree.getparent().remove(subtree)
-
-    if with_backup:
-        new_len = len(tree.text_content())
+        # expressions can select the same nodes, keep the first occurrence only
+        subtrees = list(dict.fromkeys(subtree for expression in nodelist for subtree in expression(tree)))
+        removed = {subtree for subtree in subtrees if subtree.get("preserve-content") is None}
+        removed_len = sum(len(subtree.text_content()) for subtree in removed
+                          if not any(a in removed for a in subtree.iterancestors()))
         # todo: adjust for recall and precision settings
-        return tree if new_len > old_len/7 else backup
+        if old_len - removed_len <= old_len/7:
+            return tree
+    else:
+        subtrees = (subtree for expression in nodelist for subtree in expression(tree))
+
+    for subtree in subtrees:
+        # preserve tail text from deletion
+        if subtree.tail is not None:
+            prev = subtree.getprevious()
+            if prev is None:
+                prev = subtree.getparent()
+            if prev is not None:
+                # There is a previous node, append text to its tail
+                prev.tail = (prev.tail or "") + " " + subtree.tail
+        # remove the node
+        if subtree.get("preserve-content") is None:
+            subtree.getparent().remove(subtree)
+
     return tree
 
 
@@ -161,21 +191,26 @@ def collect_link_info(links_xpath, favor_precision=False):
     '''Collect heuristics on link text'''
     # init
     mylist = []
+    lengths, shortelems = 0, 0
     # longer strings impact recall in favor of precision
     threshold = 50 if favor_precision else 10
-    # examine the elements
+    # examine the elements, gather all figures in one pass
     for subelem in links_xpath:
-        subelemtext = trim(subelem.text_content())
+        # links are mostly leaves: their text is then available directly
+        subelemtext = trim(subelem.text if len(subelem) == 0 else "".join(subelem.itertext()))
         if subelemtext:
             mylist.append(subelemtext)
-    shortelems = sum(1 for text in mylist if len(text) < threshold)
-    lengths = sum(len(text) for text in mylist)
+            textlen = len(subelemtext)
+            lengths += textlen
+            if textlen < threshold:
+                shortelems += 1
     return lengths, len(mylist), shortelems, mylist
 
 
-def link_density_test(element, text, favor_precision=False):
+def link_density_test(element, text, favor_precision=False, links=None):
     '''Remove sections which are rich in links (probably boilerplate)'''
-    links_xpath, mylist = element.findall('.//ref'), []
+    links_xpath = REF_DESCENDANTS_XPATH(element) if links is None else links
+    mylist = []
     if links_xpath:
         if element.tag == 'p': #  and not element.getparent().tag == 'item'
             if not favor_precision:
@@ -212,7 +247,7 @@ def link_density_test_tables(element):
     '''Remove tables which are rich in links (probably boilerplate)'''
     # if element.getnext() is not None:
     #     return False
-    links_xpath = element.findall('.//ref')
+    links_xpath = REF_DESCENDANTS_XPATH(element)
     if links_xpath:
         elemlen = len(trim(element.text_content()))
         if elemlen > 250:
@@ -234,10 +269,14 @@ def delete_by_link_density(subtree, tagname, backtracking=False, favor_precision
     threshold = 200 if favor_precision else 100
 
     for elem in subtree.iter(tagname):
-        if 'preserve-content' in elem.attrib:
+        if elem.get('preserve-content') is not None:
+            continue
+        # without links the element cannot be pruned: skip text extraction
+        links = REF_DESCENDANTS_XPATH(elem)
+        if not links:
             continue
         elemtext = trim(elem.text_content())
-        result, templist = link_density_test(elem, elemtext, favor_precision)
+        result, templist = link_density_test(elem, elemtext, favor_precision, links)
         if result:
             deletions.append(elem)
         elif backtracking and templist:  # if?
@@ -247,7 +286,13 @@ def delete_by_link_density(subtree, tagname, backtracking=False, favor_precision
             # else: # and not re.search(r'[?!.]', text):
             # print(elem.tag, templist)
 
-    for elem in dict.fromkeys(deletions):
+    # the list keeps the elements alive, their ids are unique
+    seen = set()
+    for elem in deletions:
+        elem_id = id(elem)
+        if elem_id in seen:
+            continue
+        seen.add(elem_id)
         parent = elem.getparent()
         if parent is not None:
             parent.remove(elem)
@@ -255,15 +300,17 @@ def delete_by_link_density(subtree, tagname, backtracking=False, favor_precision
     return subtree
 
 
-def handle_textnode(elem, options, comments_fix=True, preserve_spaces=False):
+def handle_textnode(elem, options, comments_fix=True, preserve_spaces=False,
+                    _trim=trim, _textfilter=textfilter, _duplicate_test=duplicate_test):
     "Convert, format, and probe potential text elements."
+    # helpers bound as defaults: local lookups in this per-node function
     if elem.tag == "done" or (len(elem) == 0 and not elem.text and not elem.tail):
         return None
 
     # lb bypass
     if not comments_fix and elem.tag == "lb":
         if not preserve_spaces:
-            elem.tail = trim(elem.tail)
+            elem.tail = _trim(elem.tail)
         # if textfilter(elem) is True:
         #     return None
         # duplicate_test(subelement)?
@@ -279,25 +326,26 @@ def handle_textnode(elem, options, comments_fix=True, preserve_spaces=False):
 
     # trim
     if not preserve_spaces:
-        elem.text = trim(elem.text)
+        elem.text = _trim(elem.text)
         if elem.tail:
-            elem.tail = trim(elem.tail)
+            elem.tail = _trim(elem.tail)
 
     # filter content
     # or not re.search(r'\w', element.text):  # text_content()?
-    if not elem.text and textfilter(elem) or \
-        (options.dedup and duplicate_test(elem, options)):
+    if not elem.text and _textfilter(elem) or \
+        (options.dedup and _duplicate_test(elem, options)):
         return None
     return elem
 
 
-def process_node(elem, options):
+def process_node(elem, options,
+                 _trim=trim, _textfilter=textfilter, _duplicate_test=duplicate_test):
     "Convert, format, and probe potential text elements (light format)."
     if elem.tag == "done" or (len(elem) == 0 and not elem.text and not elem.tail):
         return None
 
     # trim
-    elem.text, elem.tail = trim(elem.text), trim(elem.tail)
+    elem.text, elem.tail = _trim(elem.text), _trim(elem.tail)
 
     # adapt content string
     if elem.tag != "lb" and not elem.text and elem.tail:
@@ -305,7 +353,7 @@ def process_node(elem, options):
 
     # content checks
     if elem.text or elem.tail:
-        if textfilter(elem) or (options.dedup and duplicate_test(elem, options)):
+        if _textfilter(elem) or (options.dedup and _duplicate_test(elem, options)):
             return None
 
     return elem
@@ -336,7 +384,7 @@ def convert_quotes(elem):
         if len(children) == 1 and children[0].tag == "span":
             code_flag = True
         # find hljs elements to detect if it's code
-        code_elems = elem.xpath(".//span[starts-with(@class,'hljs')]")
+        code_elems = CODE_SPAN_XPATH(elem)
         if code_elems:
             code_flag = True
             for subelem in code_elems:
@@ -379,17 +427,19 @@ CONVERSIONS = {
     "details": convert_details,
     # wbr
 }
+CONVERSION_TAGS = tuple(CONVERSIONS)
 
 def reorder_header_elements(tree):
-    for ref in tree.xpath("//ref[head]"):
+    for ref in REF_HEAD_XPATH(tree):
         head = ref.find("head")
         if head is not None:
             # Create new <ref> element to move inside <head>
-            new_ref = Element(ref.tag, ref.attrib)
+            # makeelement() reuses the source document
+            new_ref = ref.makeelement(ref.tag, ref.attrib)
             new_ref.text = head.text
 
             # Create new <head> element and insert <ref> inside it
-            new_head = Element(head.tag, head.attrib)
+            new_head = head.makeelement(head.tag, head.attrib)
             new_head.append(new_ref)
 
             # Replace the old <ref> element with the new <head> element
@@ -398,40 +448,47 @@ def reorder_header_elements(tree):
 
 def convert_tags(tree, options, url=None):
     "Simplify markup and convert relevant HTML tags to an XML standard."
+    # tags to strip, gathered for a single traversal
+    stripping_list = []
     # delete links for faster processing
     if not options.links:
-        xpath_expr = './/div//a|.//ul//a'  # .//p//a ?
-        if options.tables:
-            xpath_expr += '|.//table//a'
+        links_xpath = LINKS_TABLES_XPATH if options.tables else LINKS_XPATH
         # necessary for further detection
-        for elem in tree.xpath(xpath_expr):
+        for elem in links_xpath(tree):
             elem.tag = 'ref'
         # strip the rest
-        strip_tags(tree, 'a')
+        stripping_list.append('a')
     else:
         # get base URL for converting relative URLs
         base_url = url and get_base_url(url)
+        base_netloc = base_url and urlsplit(base_url).netloc
         for elem in tree.iter('a', 'ref'):
             elem.tag = 'ref'
             # replace href attribute and delete the rest
             target = elem.get('href') # defaults to None
             elem.attrib.clear()
             if target:
-                # convert relative URLs
-                if base_url:
+                # convert relative URLs, absolute links to other hosts stay unchanged
+                if base_url and (
+                    not target.startswith(("http://", "https://"))
+                    or urlsplit(target).netloc in (base_netloc, "")
+                ):
                     target = fix_relative_urls(base_url, target)
                 elem.set('target', target)
 
     if options.formatting:
-        for elem in tree.iter(REND_TAG_MAPPING.keys()):
+        for elem in tree.iter(*REND_TAGS):
             elem.attrib.clear()
             elem.set('rend', REND_TAG_MAPPING[elem.tag])
             elem.tag = 'hi'
     else:
-        strip_tags(tree, *REND_TAG_MAPPING.keys())
+        stripping_list.extend(REND_TAGS)
+
+    if stripping_list:
+        strip_tags(tree, *stripping_list)
 
     # iterate over all concerned elements
-    for elem in tree.iter(CONVERSIONS.keys()):
+    for elem in tree.iter(*CONVERSION_TAGS):
         CONVERSIONS[elem.tag](elem)
     # images
     if options.images:
@@ -452,22 +509,26 @@ HTML_CONVERSIONS = {
     "ref": "a",
     "hi": lambda elem: HTML_TAG_MAPPING[elem.get('rend')]
 }
+# plain renaming vs. functions depending on the element
+HTML_TAG_CONVERSIONS = {k: v for k, v in HTML_CONVERSIONS.items() if isinstance(v, str)}
+HTML_FUNC_CONVERSIONS = {k: v for k, v in HTML_CONVERSIONS.items() if callable(v)}
 
 
 def convert_to_html(tree):
     "Convert XML to simplified HTML."
-    for elem in tree.iter(HTML_CONVERSIONS.keys()):
-        # apply function or straight conversion
-        if callable(HTML_CONVERSIONS[elem.tag]):
-            elem.tag = HTML_CONVERSIONS[elem.tag](elem)
-        else:
-            elem.tag = HTML_CONVERSIONS[elem.tag]
+    # straight conversion
+    for elem in tree.iter(*HTML_TAG_CONVERSIONS):
+        elem.tag = HTML_TAG_CONVERSIONS[elem.tag]
         # handle attributes
         if elem.tag == "a":
             elem.set("href", elem.get("target"))
             elem.attrib.pop("target")
         else:
             elem.attrib.clear()
+    # apply function, the resulting tags do not need links
+    for elem in tree.iter(*HTML_FUNC_CONVERSIONS):
+        elem.tag = HTML_FUNC_CONVERSIONS[elem.tag](elem)
+        elem.attrib.clear()
     tree.tag = "body"
     root = Element("html")
     root.append(tree)
@@ -9,7 +9,7 @@ from htmldate.meta import reset_caches as reset_caches_htmldate
 from justext.core import define_stoplist
 
 from .deduplication import LRU_TEST, Simhash, is_similar_domain
-from .utils import line_processing, return_printables_and_spaces, trim
+from .utils import PRINTABLES_TABLE
 
 
 def reset_caches() -> None:
@@ -23,9 +23,7 @@ def reset_caches() -> None:
     reset_caches_courlan()
     # own
     is_similar_domain.cache_clear()
-    line_processing.cache_clear()
-    return_printables_and_spaces.cache_clear()
-    trim.cache_clear()
+    PRINTABLES_TABLE.clear()
     LRU_TEST.clear()
     Simhash._vector_to_add.cache_clear()
     # garbage collection
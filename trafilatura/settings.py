@@ -95,10 +95,14 @@ class Extractor:
         self.format = output_format
         self.fast = fast
         self.focus = "recall" if recall else "precision" if precision else "balanced"
-        self.preserve = [re.compile(pattern) for pattern in (preserve or [])]
+        patterns = [re.compile(pattern) for pattern in (preserve or [])]
         if contacts:
-            for pattern in CONTACT_PATTERNS:
-                self.preserve.append(re.compile(pattern))
+            patterns.extend(re.compile(pattern) for pattern in CONTACT_PATTERNS)
+        # single alternation: each text segment is scanned only once,
+        # unless groups or flags would interfere across patterns
+        if len(patterns) > 1 and all(p.groups == 0 and p.flags == re.UNICODE for p in patterns):
+            patterns = [re.compile("|".join(f"(?:{p.pattern})" for p in patterns))]
+        self.preserve = tuple(patterns)
         self.comments = comments
         self.formatting = formatting or output_format == "markdown"
         self.links = links
@@ -216,11 +220,11 @@ MAX_SITEMAPS_SEEN = 10**4
 
 
 # filters
-CUT_EMPTY_ELEMS = {'article', 'b', 'blockquote', 'dd', 'div', 'dt', 'em',
-                   'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'i', 'li', 'main',
-                   'p', 'pre', 'q', 'section', 'span', 'strong'}
-                   # 'meta', 'td', 'a', 'caption', 'dl', 'header',
-                   # 'colgroup', 'col',
+CUT_EMPTY_ELEMS = frozenset(['article', 'b', 'blockquote', 'dd', 'div', 'dt', 'em',
+                             'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'i', 'li', 'main',
+                             'p', 'pre', 'q', 'section', 'span', 'strong'])
+                             # 'meta', 'td', 'a', 'caption', 'dl', 'header',
+                             # 'colgroup', 'col',
 #CUT_EMPTY_ELEMS = {'div', 'span'}
 
 # order could matter, using lists to keep extraction deterministic
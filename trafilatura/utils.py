@@ -4,12 +4,12 @@ Module bundling functions related to HTML and text processing,
 content filtering and language detection.
 """
 
-import gzip
 import logging
 import re
 import zlib
 
-from functools import lru_cache
+from collections import deque
+from codecs import BOM_UTF16_BE, BOM_UTF16_LE, getincrementaldecoder
 from itertools import islice
 from unicodedata import normalize
 
@@ -24,6 +24,11 @@ TARGET_ENCODINGS = [
 ]
 
 # response compression
+try:
+    from isal.igzip import decompress as gzip_decompress  # faster if installed
+except ImportError:
+    from gzip import decompress as gzip_decompress
+
 try:
     import brotli
     HAS_BROTLI = True
@@ -49,6 +54,7 @@ try:
 except ImportError:
     cchardet_detect = None
 from charset_normalizer import from_bytes
+from lxml.etree import XPath
 from lxml.html import HtmlElement, HTMLParser, fromstring
 # response types
 from urllib3.response import HTTPResponse
@@ -57,34 +63,54 @@ from urllib3.response import HTTPResponse
 LOGGER = logging.getLogger(__name__)
 
 UNICODE_ALIASES = {'utf-8', 'utf_8'}
+# bytes never found inside multibyte characters of ASCII-compatible encodings
+SAFE_CUTS = (b">", b"<", b"\n", b" ")
+WIDE_BOMS = (BOM_UTF16_BE, BOM_UTF16_LE)
+UTF8_FULL_CHECK = 1_000_000
+UTF8_SAMPLE = 100_000
 
 DOCTYPE_TAG = re.compile("^< ?! ?DOCTYPE.+?/ ?>", re.I)
 FAULTY_HTML = re.compile(r"(<html.*?)\s*/>", re.I)
 HTML_STRIP_TAGS = re.compile(r'(<!--.*?-->|<[^>]*>)')
+# same test as in LXML: Unicode strings with encoding declaration are not supported
+XML_ENCODING_DECLARATION = re.compile(r'^(<\?xml[^>]+)\s+encoding\s*=\s*["\'][^"\']*["\'](\s*\?>|)')
 
 # note: htmldate could use HTML comments
 # huge_tree=True, remove_blank_text=True
 HTML_PARSER = HTMLParser(collect_ids=False, default_doctype=False, encoding='utf-8', remove_comments=True, remove_pis=True)
 
 LINES_TRIMMING = re.compile(r'(?<![p{P}>])\n', flags=re.UNICODE|re.MULTILINE)
+# spacing HTML entities: https://www.w3.org/MarkUp/html-spec/html-spec_13.html
+HTML_SPACE_ENTITIES = re.compile(r'&(?:#1[03]|nbsp);')
 
 URL_BLACKLIST_REGEX = re.compile(r'^https?://|/+$')
 
 # Regex to check image file extensions
-IMAGE_EXTENSION = re.compile(r'[^\s]+\.(avif|bmp|gif|hei[cf]|jpe?g|png|webp)(\b|$)')
+# a lookbehind instead of a leading [^\s]+ avoids quadratic backtracking on long strings
+IMAGE_EXTENSION = re.compile(r'(?<=\S)\.(?:avif|bmp|gif|hei[cf]|jpe?g|png|webp)\b')
 
-FORMATTING_PROTECTED = {'cell', 'head', 'hi', 'item', 'p', 'quote', 'ref', 'td'}
-SPACING_PROTECTED = {'code', 'pre'}
+FORMATTING_PROTECTED = frozenset(['cell', 'head', 'hi', 'item', 'p', 'quote', 'ref', 'td'])
+SPACING_PROTECTED = frozenset(['code', 'pre'])
 
 # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Language
 TARGET_LANG_ATTRS = ('http-equiv="content-language"', 'property="og:locale"')
+TARGET_LANG_XPATHS = tuple(XPath(f'.//meta[@{attr}][@content]') for attr in TARGET_LANG_ATTRS)
+HTML_LANG_XPATH = XPath('//html[@lang]')
 RE_HTML_LANG = re.compile(r'([a-z]{2})')
 
 # Mostly filters for social media
-RE_FILTER = re.compile(r'\W*(Drucken|E-?Mail|Facebook|Flipboard|Google|Instagram|'
+# leading non-word characters are matched atomically: (?=(\W*))\1 prevents backtracking
+RE_FILTER = re.compile(r'(?=(\W*))\1(Drucken|E-?Mail|Facebook|Flipboard|Google|Instagram|'
                         'Linkedin|Mail|PDF|Pinterest|Pocket|Print|QQ|Reddit|Twitter|'
                         'WeChat|WeiBo|Whatsapp|Xing|Mehr zum Thema:?|More on this.{,8}$)$',
                        flags=re.IGNORECASE)
+
+# magic numbers of compressed files
+# source: https://stackoverflow.com/questions/3703276/how-to-tell-if-a-file-is-gzip-compressed
+COMPRESSION_SIGNATURES = [(b"\x1f\x8b\x08", gzip_decompress, "GZ")]
+if HAS_ZSTD:
+    COMPRESSION_SIGNATURES.append((b"\x28\xb5\x2f\xfd", zstandard.decompress, "ZSTD"))  # max_output_size=???
+
 # COMMENTS_BLACKLIST = ('( Abmelden / Ändern )') # Fill in your details below|Trage deine Daten unten|Kommentar verfassen|Bitte logge dich|Hinterlasse einen Kommentar| to %s| mit %s)
 
 
@@ -96,34 +122,41 @@ def handle_compressed_file(filecontent):
     if not isinstance(filecontent, bytes):
         return filecontent
 
-    # source: https://stackoverflow.com/questions/3703276/how-to-tell-if-a-file-is-gzip-compressed
-    if filecontent[:3] == b"\x1f\x8b\x08":
-        try:
-            return gzip.decompress(filecontent)
-        except Exception:  # EOFError, OSError, gzip.BadGzipFile
-            LOGGER.warning("invalid GZ file")
-    # try zstandard
-    if HAS_ZSTD and filecontent[:4] == b"\x28\xb5\x2f\xfd":
-        try:
-            return zstandard.decompress(filecontent)  # max_output_size=???
-        except zstandard.ZstdError:
-            LOGGER.warning("invalid ZSTD file")
-    # try brotli
+    # try gzip and zstandard
+    for signature, decompress, name in COMPRESSION_SIGNATURES:
+        if filecontent.startswith(signature):
+            try:
+                return decompress(filecontent)
+            except Exception:  # EOFError, OSError, gzip.BadGzipFile, zstandard.ZstdError
+                LOGGER.warning("invalid %s file", name)
+    # try brotli, no magic number
     if HAS_BROTLI:
         try:
             return brotli.decompress(filecontent)
         except brotli.error:
             pass  # logging.debug('invalid Brotli file')
-    # try zlib/deflate
-    try:
-        return zlib.decompress(filecontent)
-    except zlib.error:
-        pass
+    # try zlib/deflate if the header is valid
+    if is_zlib_header(filecontent[:2]):
+        try:
+            return zlib.decompress(filecontent)
+        except zlib.error:
+            pass
 
     # return content unchanged if decompression failed
     return filecontent
 
 
+def is_zlib_header(header):
+    """Check the deflate method, the window size and the checksum
+       of a zlib header, see RFC 1950."""
+    return (
+        len(header) == 2
+        and header[0] & 0x0F == 8
+        and header[0] >> 4 <= 7
+        and (header[0] * 256 + header[1]) % 31 == 0
+    )
+
+
 def isutf8(data):
     """Simple heuristic to determine if a bytestring uses standard unicode encoding"""
     try:
@@ -132,19 +165,20 @@ def isutf8(data):
         return False
     return True
 
-def is_utf8(data, chunk_size=1024, sample_rate=0.1):
-    """Check if data is utf-8 encoded by decoding in chunks."""
-    total_chunks = len(data) // chunk_size
-    if total_chunks == 0:
-        total_chunks = 1
-    sample_chunks = max(int(total_chunks * sample_rate), 1)
-    for i in range(sample_chunks):
-        start = (len(data) // sample_chunks) * i
-        end = start + chunk_size
-        try:
-            data[start:end].decode('utf-8')
-        except UnicodeDecodeError:
-            return False
+def is_utf8(data):
+    """Check if data is utf-8 encoded, only decoding the beginning
+       and the end of large inputs."""
+    if len(data) <= UTF8_FULL_CHECK:
+        return isutf8(data)
+    # skip the continuation bytes of a character cut at the start of the tail
+    tail = data[-UTF8_SAMPLE:]
+    start = next((i for i in range(3) if not 0x80 <= tail[i] < 0xC0), 3)
+    try:
+        # the incremental decoder accepts a character cut at the end of the head
+        getincrementaldecoder('utf-8')().decode(data[:UTF8_SAMPLE])
+        tail[start:].decode('utf-8')
+    except UnicodeDecodeError:
+        return False
     return True
 
 def detect_encoding(bytesobject):
@@ -159,8 +193,16 @@ def detect_encoding(bytesobject):
     if len(bytesobject) < 10000:
         detection_results = from_bytes(bytesobject)
     else:
-        detection_results = from_bytes(bytesobject[:5000] + bytesobject[-5000:]) or \
-                            from_bytes(bytesobject)
+        head, tail = bytesobject[:5000], bytesobject[-5000:]
+        # cut the sample on single-byte characters so that multibyte ones stay whole,
+        # except for UTF-16/32 where these bytes are only part of a code unit
+        if not bytesobject.startswith(WIDE_BOMS) and b"\x00" not in head:
+            head_end = max(bytesobject.rfind(char, 4000, 5000) for char in SAFE_CUTS) + 1
+            tail_starts = [i for i in (bytesobject.find(char, -5000, -4000) for char in SAFE_CUTS) if i != -1]
+            if head_end and tail_starts:
+                head, tail = bytesobject[:head_end], bytesobject[min(tail_starts):]
+        # raw cuts may split characters, resort to the whole document
+        detection_results = from_bytes(head + tail) or from_bytes(bytesobject)
     if len(detection_results) > 0:
         guesses.extend([r.encoding for r in detection_results])
 
@@ -201,6 +243,39 @@ def decode_file(filecontent):
     return htmltext or str(filecontent, encoding='utf-8', errors='replace')
 
 
+def _decode_chunk(filecontents):
+    "Decode a chunk of bytestrings in a worker process."
+    return [decode_file(filecontent) for filecontent in filecontents]
+
+
+def decode_files(filecontents, workers=None):
+    """Decode a series of bytestrings with decode_file() in parallel,
+       using a pool of processes, and yield the results in order.
+       Where processes are spawned (macOS, Windows), calls have to be
+       protected by an if __name__ == "__main__" guard.
+       Consume the generator fully or close() it: when stopping early,
+       pending tasks are cancelled and the running ones are waited for."""
+    # imported here: multiprocessing would slow down every import of the package
+    from concurrent.futures import ProcessPoolExecutor
+    # no initializer (Python 3.7+): workers load charset_normalizer
+    # and compile the regexes when importing this module
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # tasks of 16 documents, at most about 2000 documents in flight
+        # so that memory use is bounded and the workers stay busy
+        futures = deque()
+        try:
+            for chunk in make_chunks(filecontents, 16):
+                futures.append(executor.submit(_decode_chunk, chunk))
+                if len(futures) > 125:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+        finally:
+            # early stop: do not wait for tasks which have not started
+            for future in futures:
+                future.cancel()
+
+
 def is_dubious_html(beginning: str) -> bool:
     "Assess if the object is proper HTML (awith a corresponding tag or declaration)."
     return "html" not in beginning
@@ -210,10 +285,16 @@ def repair_faulty_html(htmlstring: str, beginning: str) -> str:
     "Repair faulty HTML strings to make then palatable for libxml2."
     # libxml2/LXML issue: https://bugs.launchpad.net/lxml/+bug/1955915
     if "doctype" in beginning:
-        firstline, _, rest = htmlstring.partition("\n")
-        htmlstring = DOCTYPE_TAG.sub("", firstline, count=1) + "\n" + rest
+        # the anchored pattern stays on the first line, no need to split the document
+        if "\n" not in htmlstring:
+            htmlstring += "\n"
+        htmlstring = DOCTYPE_TAG.sub("", htmlstring, count=1)
     # other issue with malformed documents: check first three lines
-    for i, line in enumerate(iter(htmlstring.splitlines())):
+    # only split the beginning of the document, the first lines are whole if more follow
+    lines = htmlstring[:1024].splitlines()
+    if len(lines) < 5:
+        lines = htmlstring.splitlines()
+    for i, line in enumerate(lines):
         if "<html" in line and line.endswith("/>"):
             htmlstring = FAULTY_HTML.sub(r"\1>", htmlstring, count=1)
             break
@@ -225,8 +306,11 @@ def repair_faulty_html(htmlstring: str, beginning: str) -> str:
 def fromstring_bytes(htmlobject):
     "Try to pass bytes to LXML parser."
     tree = None
+    # bytes are passed as they are, without a decoding and re-encoding round
+    if isinstance(htmlobject, str):
+        htmlobject = htmlobject.encode("utf8", "surrogatepass")
     try:
-        tree = fromstring(htmlobject.encode("utf8", "surrogatepass"), parser=HTML_PARSER)
+        tree = fromstring(htmlobject, parser=HTML_PARSER)
     except Exception as err:
         LOGGER.error("lxml parser bytestring %s", err)
     return tree
@@ -256,14 +340,19 @@ def load_html(htmlobject):
     htmlobject = repair_faulty_html(htmlobject, beginning)
     # first pass: use Unicode string
     fallback_parse = False
-    try:
-        tree = fromstring(htmlobject, parser=HTML_PARSER)
-    except ValueError:
-        # "Unicode strings with encoding declaration are not supported."
+    # go straight to the bytes instead of waiting for a ValueError
+    if XML_ENCODING_DECLARATION.match(htmlobject):
         tree = fromstring_bytes(htmlobject)
         fallback_parse = True
-    except Exception as err:  # pragma: no cover
-        LOGGER.error("lxml parsing failed: %s", err)
+    else:
+        try:
+            tree = fromstring(htmlobject, parser=HTML_PARSER)
+        except ValueError:
+            # "Unicode strings with encoding declaration are not supported."
+            tree = fromstring_bytes(htmlobject)
+            fallback_parse = True
+        except Exception as err:  # pragma: no cover
+            LOGGER.error("lxml parsing failed: %s", err)
     # second pass: try passing bytes to LXML
     if (tree is None or len(tree) < 1) and not fallback_parse:
         tree = fromstring_bytes(htmlobject)
@@ -277,15 +366,25 @@ def load_html(htmlobject):
     return tree
 
 
-@lru_cache(maxsize=2**14)  # sys.maxunicode = 1114111
-def return_printables_and_spaces(char):
-    'Return a character if it belongs to certain classes'
-    return char if char.isprintable() or char.isspace() else ''
+class PrintablesTable(dict):
+    "Translation table filled on demand, keeps printable and space characters."
+    maxsize = 2**14
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        value = codepoint if char.isprintable() or char.isspace() else None
+        # bounded like an LRU cache: further code points are not stored
+        if len(self) < self.maxsize:
+            self[codepoint] = value
+        return value
+
+
+PRINTABLES_TABLE = PrintablesTable()
 
 
 def remove_control_characters(string):
     '''Prevent non-printable and XML invalid character errors'''
-    return ''.join(map(return_printables_and_spaces, string))
+    return string.translate(PRINTABLES_TABLE)
 
 
 def normalize_unicode(string, unicodeform='NFC'):
@@ -293,13 +392,15 @@ def normalize_unicode(string, unicodeform='NFC'):
     return normalize(unicodeform, string)
 
 
-@lru_cache(maxsize=1024)
 def line_processing(line, preserve_space=False, trailing_space=False):
     '''Remove HTML space entities, then discard incompatible unicode
        and invalid XML characters on line level'''
     # spacing HTML entities: https://www.w3.org/MarkUp/html-spec/html-spec_13.html
-    # unique code spaces
-    new_line = remove_control_characters(line.replace('&#13;', '\r').replace('&#10;', '\n').replace('&nbsp;', '\u00A0'))
+    # unique code spaces, most lines have no entities at all
+    new_line = line
+    if '&' in new_line:
+        new_line = new_line.replace('&#13;', '\r').replace('&#10;', '\n').replace('&nbsp;', '\u00A0')
+    new_line = remove_control_characters(new_line)
     if not preserve_space:
         # remove newlines that are not related to punctuation or markup
         # remove non-printable chars and normalize space characters (including Unicode spaces)
@@ -319,45 +420,57 @@ def sanitize(text, preserve_space=False, trailing_space=False):
     # consider all text as a single line
     if trailing_space:
         return line_processing(text, preserve_space, True)
-    # process line by line
     try:
-        return '\n'.join(filter(None, (line_processing(l, preserve_space) for l in text.splitlines()))).replace('\u2424', '')
-    except AttributeError:
+        # process the whole text at once: lines are trimmed so entities are just spaces
+        if not preserve_space:
+            text = HTML_SPACE_ENTITIES.sub(' ', text).translate(PRINTABLES_TABLE)
+            lines = map(trim, text.splitlines())
+        # process line by line
+        else:
+            lines = (line_processing(l, preserve_space) for l in text.splitlines())
+        return '\n'.join(filter(None, lines)).replace('\u2424', '')
+    except (AttributeError, TypeError):
         return None
 
 
 def sanitize_tree(tree):
     '''Trims spaces, removes control characters and normalizes unicode'''
+    nsmap = tree.nsmap
     for elem in tree.iter():
+        # remove invalid attributes, keys() is a list built beforehand
+        for attribute in elem.keys():
+            if ':' in attribute:  # colon is reserved for namespaces in XML
+                if not elem.get(attribute) or attribute.split(':', 1)[0] not in nsmap:
+                    del elem.attrib[attribute]
+
+        # no need to look at the parent if there is nothing to sanitize
+        text, tail = elem.text, elem.tail
+        if not text and not tail:
+            continue
+        # each access to the tag creates a new string
+        tag = elem.tag
         parent = elem.getparent()
         parent_tag = parent.tag if parent is not None else ""
 
         # preserve space if the element or its parent is a specific tag, or if the element has text and children
         # the last part is relevant for item elements with ref inside for example
-        preserve_space = elem.tag in SPACING_PROTECTED or parent_tag in SPACING_PROTECTED
-        trailing_space = elem.tag in FORMATTING_PROTECTED or parent_tag in FORMATTING_PROTECTED or preserve_space
-
-        # remove invalid attributes
-        for attribute in elem.attrib:
-            if ':' in attribute:  # colon is reserved for namespaces in XML
-                if not elem.attrib[attribute] or attribute.split(':', 1)[0] not in tree.nsmap:
-                    elem.attrib.pop(attribute)
+        preserve_space = tag in SPACING_PROTECTED or parent_tag in SPACING_PROTECTED
+        trailing_space = preserve_space or tag in FORMATTING_PROTECTED or parent_tag in FORMATTING_PROTECTED
 
-        if elem.text:
-            elem.text = sanitize(elem.text, preserve_space, trailing_space)
-        if elem.tail:
-            elem.tail = sanitize(elem.tail, preserve_space, trailing_space)
+        if text:
+            elem.text = sanitize(text, preserve_space, trailing_space)
+        if tail:
+            elem.tail = sanitize(tail, preserve_space, trailing_space)
     return tree
 
 
-@lru_cache(maxsize=1024)
 def trim(string):
     '''Remove unnecessary spaces within a text string'''
     try:
         # remove newlines that are not related to punctuation or markup + proper trimming
         # return LINES_TRIMMING.sub(r' ', string).strip(' \t\n\r\v')
-        # faster:
-        return ' '.join(string.split()).strip()
+        # faster, the joined tokens carry no leading or trailing spaces:
+        return ' '.join(string.split())
     except (AttributeError, TypeError):
         return None
 
@@ -368,20 +481,23 @@ def is_image_file(imagesrc):
     return bool(imagesrc is not None and IMAGE_EXTENSION.search(imagesrc))
 
 
-def make_chunks(iterable, n):
-    """
-    Chunk data into smaller pieces.
-    https://docs.python.org/3/library/itertools.html
-    """
-    it = iter(iterable)
-    while True:
-        chunk = tuple(islice(it, n))
-        if not chunk:
-            return
-        yield chunk
-    # Python 3.8+ with walrus operator
-    # while batch := tuple(islice(it, n)):
-    #    yield batch
+try:  # Python 3.12+
+    from itertools import batched as make_chunks
+except ImportError:
+    def make_chunks(iterable, n):
+        """
+        Chunk data into smaller pieces.
+        https://docs.python.org/3/library/itertools.html
+        """
+        it = iter(iterable)
+        while True:
+            chunk = tuple(islice(it, n))
+            if not chunk:
+                return
+            yield chunk
+        # Python 3.8+ with walrus operator
+        # while batch := tuple(islice(it, n)):
+        #    yield batch
 
 
 def is_acceptable_length(my_len, options):
@@ -398,8 +514,8 @@ def is_acceptable_length(my_len, options):
 def check_html_lang(tree, target_language, strict=False):
     """Check HTML meta-elements for language information and split
        the result in case there are several languages."""
-    for attr in TARGET_LANG_ATTRS:
-        elems = tree.findall(f'.//meta[@{attr}][@content]')
+    for attr, lang_xpath in zip(TARGET_LANG_ATTRS, TARGET_LANG_XPATHS):
+        elems = lang_xpath(tree)
         if elems:
             if any(target_language in RE_HTML_LANG.split(elem.get("content", "").lower()) for elem in elems):
                 return True
@@ -408,7 +524,7 @@ def check_html_lang(tree, target_language, strict=False):
 
     # HTML lang attribute: sometimes a wrong indication
     if strict:
-        elems = tree.xpath("//html[@lang]")
+        elems = HTML_LANG_XPATH(tree)
         if elems:
             if any(target_language in RE_HTML_LANG.split(elem.get("lang", "").lower()) for elem in elems):
                 return True
@@ -422,11 +538,11 @@ def check_html_lang(tree, target_language, strict=False):
 def language_classifier(temp_text, temp_comments):
     '''Run external component (if installed) for language identification'''
     if LANGID_FLAG is True:
-        result, _ = (
-            py3langid.classify(temp_text)
-            if len(temp_text) > len(temp_comments)
-            else py3langid.classify(temp_comments)
-        )
+        text = temp_text if len(temp_text) > len(temp_comments) else temp_comments
+        # nothing to classify, the detector would return an arbitrary language
+        if not text or text.isspace():
+            return None
+        result, _ = py3langid.classify(text)
     else:
         LOGGER.warning('Language detector not installed, skipping detection')
         result = None